@@ -1,99 +1,124 @@
 """Package to join a twitch streamer's chat and earn streamelements points."""
 
-import json, aiohttp, bottom, asyncio, signal
-from typing import Optional, List
+import orjson, aiohttp, bottom, asyncio, signal, time, functools, hashlib
+from typing import Iterable, Optional, List, Set
 from rich.console import Console
 from pathlib import Path
-from collections import ChainMap
 
 """
 References
 - https://dev.twitch.tv/docs/irc
 - https://github.com/numberoverzero/bottom
 
-- https://bottom-docs.readthedocs.io (Functions keepalive, handle_sigint and handle are directly copied from here.
+- https://bottom-docs.readthedocs.io (Functions keepalive and handle are directly copied from here, handle is only registered through `loop.add_signal_handler` now.
 - https://github.com/jschlenker/twitch-multistream-chat (Tried using this, but it became impractical to keep modifying it to stop breaking/suit my needs. I wrote this program as a kind of 'rewrite', taking reference from `twitch-multistream-chat`)
 """
 
 # --- Constants --- #
 
 config_path = Path(__file__).parent / "config.json"
+validated_path = config_path.with_suffix(".validated")  # Holds the hash of the last config that passed validation
 console = Console()
 
-with open(config_path, "r") as handler:
-    config = json.load(handler)
-    console.log("[cyan][LOG][/cyan] - Config Loaded, {}".format(config))
-STREAMER_LISTS = {"joined": set(), "offline": set(config.get("channels"))}
+with open(config_path, "rb") as handler:
+    raw_config = handler.read()
+    config = orjson.loads(raw_config)
+    console.log(f"[cyan][LOG][/cyan] - Config Loaded, {config}")
+CHANNEL_IRC = {
+    name.lower(): f"#{name.lower()}" for name in config.get("channels") or []
+}  # IRC channel names, built once instead of on every join/leave
+STREAMER_LISTS = {
+    "joined": set(),
+    "offline": set(CHANNEL_IRC),
+}  # "offline" is every configured channel that isn't currently joined
+STREAMS_BATCH_SIZE = 100  # Maximum user_login parameters Helix's /streams endpoint accepts per request
+JOIN_BATCH_SIZE = 20  # Channels per JOIN/PART line, Twitch counts every channel in a line towards its ~20 JOINs per 10 seconds limit for non-verified bots
+JOIN_BATCH_INTERVAL = 10  # Seconds to wait between JOIN lines, so each line gets a fresh rate limit window
+EVENTSUB_URL = "wss://eventsub.wss.twitch.tv/ws"
+EVENTSUB_RECEIVE_TIMEOUT = 30  # Twitch sends a keepalive every 10 seconds by default
+EVENTSUB_MAX_RETRY_DELAY = 300  # Reconnects back off up to this many seconds, so a persistent failure doesn't hammer twitch
+EVENTSUB_RECONCILE_INTERVAL = 3600  # How often channels covered by EventSub are still polled, as a safety net
+EVENTSUB_GRACE = 600  # Helix can take a few minutes to catch up with stream.online/stream.offline, polling doesn't override EventSub during that window
+EVENTSUB_ONLINE_AT = {}  # login -> time.monotonic() of the last stream.online notification
+EVENTSUB_OFFLINE_AT = {}  # login -> time.monotonic() of the last stream.offline notification
+STREAMER_LISTS_LOCK = asyncio.Lock()  # Held while joining/leaving, so polling and EventSub don't interleave their JOIN/PARTs
+EVENTSUB_CHANNELS = {}  # login -> user id of channels with both stream.online and stream.offline subscribed on the current EventSub session
+_TOKEN_CACHE = {"token": None, "expires_at": 0.0}  # Client credentials tokens live for ~60 days, no need to refetch every loop
+SESSION: Optional[aiohttp.ClientSession] = None  # Created once in main(), shared by every request
 
 # --- Validate Config --- #
 
+_MISSING = object()  # Sentinel for keys absent from the config, since None/False/0 are all valid JSON values
+REQUIRED_KEYS = {
+    "bot_username": str,
+    "client_id": str,
+    "client_secret": str,
+    "oauth_token": str,
+    "channels": list,
+    "wait_time": int,
+    "verbose": bool
+}
+OPTIONAL_KEYS = {
+    "verbose_chat": bool,
+    "eventsub": bool,
+}
+
 
 def validate_config():
-    """Makes sure all the required keys are in the configuration file."""
-
-    required_keys = {
-        "bot_username": str,
-        "client_id": str,
-        "client_secret": str,
-        "oauth_token": str,
-        "channels": list,
-        "wait_time": int,
-        "verbose": bool
-    }
+    """Makes sure all the required keys are in the configuration file, and that any optional keys present are of the right type."""
 
-    # Key Presence Validation
-    not_present_keys = [k for k in required_keys if k not in config]
     errors = []
-    for key in not_present_keys:
-        console.log(
-            "[red][ERROR][/red] Key `{}` not present in configuration file ({}), please verify.".format(
-                key, config_path.absolute()
-            )
-        )
-        errors.append(KeyError(key))
+    for key, expected_type in {**REQUIRED_KEYS, **OPTIONAL_KEYS}.items():
+        value = config.get(key, _MISSING)
 
-    if len(not_present_keys) != 0:
-        raise Exception(errors)
+        if value is _MISSING and key in OPTIONAL_KEYS:
+            continue
 
-    # Value Validation
-    not_present_values = [(k, v) for k, v in config.items() if not v and type(v) is not bool]
-    errors = []
-    for key, value in not_present_values:
-        console.log(
-            "[red][ERROR][/red] Key `{}` has no value (`{}`). Value should also be of type `{}`. Configuration File - {}".format(
-                key, value, required_keys.get(key), config_path.absolute()
+        # Key Presence Validation
+        elif value is _MISSING:
+            console.log(
+                f"[red][ERROR][/red] Key `{key}` not present in configuration file ({config_path.absolute()}), please verify."
             )
-        )
-        errors.append(TypeError(key))
+            errors.append(KeyError(key))
 
-    if len(not_present_values) != 0:
-        raise Exception(errors)
+        # Value Type Validation, bool is a subclass of int so it has to be ruled out explicitly
+        elif not isinstance(value, expected_type) or (
+            expected_type is not bool and isinstance(value, bool)
+        ):
+            console.log(
+                f"[red][ERROR][/red] Key `{key}`'s value (`{value}`) is of type `{type(value).__name__}` when it should be of type `{expected_type.__name__}`.\nConfiguration File - {config_path.absolute()}"
+            )
+            errors.append(TypeError(key))
 
-    # Value Type Validation
-    bad_type_values = [
-        (k, v) for k, v in config.items() if required_keys.get(k) is not type(v)
-    ]
-    errors = []
-    for key, value in bad_type_values:
-        console.log(
-            "[red][ERROR][/red] Key `{}`'s value (`{}`) is of type `{}` when it should be of type `{}`.\nConfiguration File - {}".format(
-                key,
-                value,
-                type(value),
-                type(required_keys.get(key)),
-                config_path.absolute(),
+        # Value Validation
+        elif not value and expected_type is not bool:
+            console.log(
+                f"[red][ERROR][/red] Key `{key}` has no value (`{value}`). Value should also be of type `{expected_type.__name__}`. Configuration File - {config_path.absolute()}"
             )
-        )
-        errors.append(TypeError(key))
+            errors.append(TypeError(key))
 
-    if len(bad_type_values) != 0:
+    if len(errors) != 0:
         raise Exception(errors)
 
     # --- #
     return True
 
 
-validate_config()
+# The schema is part of the hash, so a cached verdict doesn't outlive a change to the keys being validated
+config_hash = hashlib.sha256(
+    repr((REQUIRED_KEYS, OPTIONAL_KEYS)).encode() + raw_config
+).hexdigest()
+try:
+    cached_hash = validated_path.read_text() if validated_path.exists() else None
+except OSError:
+    cached_hash = None  # Unreadable cache, validate as if there was none
+
+if cached_hash != config_hash:
+    validate_config()
+    try:
+        validated_path.write_text(config_hash)
+    except OSError:
+        pass  # Not being able to cache the result only means validating again next start
 
 # --- Events --- #
 
@@ -118,7 +143,7 @@ async def connect(**kwargs):
 @bot.on("CLIENT_DISCONNECT")
 async def reconnect(**kwargs):
     # Wait a second so we don't flood
-    await asyncio.sleep(2, loop=bot.loop)  # type: ignore
+    await asyncio.sleep(2)
 
     # Wait until we've reconnected
     await bot.connect()
@@ -129,23 +154,18 @@ def keepalive(message, **kwargs):
     bot.send("PONG", message=message)
 
 
-def handle_sigint(signum, frame):
-    console.log("[green][EXIT][/green] - CTRL+C Recieved, cleaning up.")
-    asyncio.create_task(handle())
-
-
-signal.signal(signal.SIGINT, handle_sigint)
-
-
 async def handle(**kwargs):
-    console.log("[cyan][LOG][/cyan] - Stopping")
+    console.log("[green][EXIT][/green] - Stopping, cleaning up.")
     try:
         await asyncio.wait_for(bot.disconnect(), timeout=5)
     except asyncio.TimeoutError:
         console.log("[yellow][WARNING][/yellow] Disconnect timed out")
 
-    # Signal a stop before disconnecting so that any reconnect
-    # coros aren't run by the last run_forever sweep.
+    if SESSION is not None and not SESSION.closed:
+        await SESSION.close()
+
+    # Stop the loop so any reconnect coros scheduled by the disconnect
+    # aren't run before run_until_complete(main()) returns.
 
     async def stop():
         bot.loop.stop()
@@ -164,7 +184,7 @@ async def handle(**kwargs):
 
 
 async def retrieve_access_token(
-    client_id: str, client_secret: str, _session: Optional[aiohttp.ClientSession] = None
+    client_id: str, client_secret: str, session: aiohttp.ClientSession
 ):
     """Retrieves the access token by sending a client credentials request to twitch."""
 
@@ -174,83 +194,96 @@ async def retrieve_access_token(
         "grant_type": "client_credentials",
     }
 
-    session = _session or aiohttp.ClientSession()
+    assert session is not None, "A shared aiohttp.ClientSession must be provided."
 
     async with session.post("https://id.twitch.tv/oauth2/token", json=body) as response:
-        response_data = await response.json()
+        response_data = await response.json(loads=orjson.loads)
 
-        if response.status == 500:
+        if response.status >= 500:
             console.log(
-                "[red][ERROR]/[red] Failed to fetch access token.\nResponse: {}\nJSON: {}\nBody: {}".format(
-                    response, response_data, body
-                )
+                f"[red][ERROR]/[red] Failed to fetch access token.\nResponse: {response}\nJSON: {response_data}\nBody: {body}"
             )
             raise Exception("Failed to fetch access token.")
 
-        elif not str(response.status).startswith(
-            "2"
-        ):  # Status Code doesn't start with two
+        elif not 200 <= response.status < 300:
             console.log(
-                "[yellow][WARNING][/yellow] Status Code for access token fetch is not in the 200 Range.\nResponse: {}\nJSON: {}\nBody: {}".format(
-                    response, response_data, body
-                )
+                f"[yellow][WARNING][/yellow] Status Code for access token fetch is not in the 200 Range.\nResponse: {response}\nJSON: {response_data}\nBody: {body}"
             )
 
     access_token = response_data.get("access_token")
     if access_token is None:
         console.log(
-            "[red][ERROR][/red] Access token is not present in response, please check logs.\nJSON: {}\nBody: {}".format(
-                response_data, body
-            )
+            f"[red][ERROR][/red] Access token is not present in response, please check logs.\nJSON: {response_data}\nBody: {body}"
         )
         raise KeyError("access_token")
 
-    if (
-        not session == _session
-    ):  # When the program creates its own session (with the or statement), this condition will be True
-        await session.close()
+    return access_token, response_data.get("expires_in", 0)
+
+
+async def get_access_token(session: aiohttp.ClientSession, force_refresh: bool = False):
+    """Returns the cached access token, only fetching a new one when it's missing, close to expiring or `force_refresh` is set."""
+
+    if not force_refresh and time.monotonic() < _TOKEN_CACHE["expires_at"] - 60:
+        return _TOKEN_CACHE["token"]
+
+    access_token, expires_in = await retrieve_access_token(
+        config["client_id"], config["client_secret"], session=session
+    )
+    _TOKEN_CACHE["token"] = access_token
+    _TOKEN_CACHE["expires_at"] = time.monotonic() + expires_in
+    config["access_token"] = access_token
 
     return access_token
 
 
-async def retrieve_streaming_status(
-    client_id: str,
-    access_token: str,
-    streamer_name: str,
-    _session: Optional[aiohttp.ClientSession] = None,
+async def retrieve_streaming_statuses(
+    headers: dict,
+    streamer_names: List[str],
+    session: aiohttp.ClientSession,
 ):
-    """Retrieves streamer status, ie, whether they're streaming or not at the moment."""
+    """Retrieves the status of up to 100 streamers in one request, ie, whether they're streaming or not at the moment."""
 
-    headers = {"Client-ID": client_id, "Authorization": "Bearer " + access_token}
-    session = _session or aiohttp.ClientSession()
+    assert session is not None, "A shared aiohttp.ClientSession must be provided."
+    assert len(streamer_names) <= STREAMS_BATCH_SIZE, f"Helix accepts at most {STREAMS_BATCH_SIZE} user_login parameters per request."
 
     async with session.get(
-        "https://api.twitch.tv/helix/streams?user_login={}".format(streamer_name),
+        "https://api.twitch.tv/helix/streams",
+        # Helix only returns 20 streams per page by default, ask for the whole batch so live channels past the 20th aren't read as offline
+        params=[("user_login", name) for name in streamer_names]
+        + [("first", str(STREAMS_BATCH_SIZE))],
         headers=headers,
     ) as response:
-        response_data = await response.json()
+        response_data = await response.json(loads=orjson.loads)
+
+        if response.status == 401:
+            # Access token expired or was revoked, the caller should refresh it
+            console.log(
+                f"[yellow][WARNING][/yellow] Access token was rejected while fetching streams.\nJSON: {response_data}"
+            )
+            raise PermissionError("access_token")
 
         if type(response_data.get("data")) is not list:
             # something went wrong with the request
 
             console.log(
-                "[red][ERROR][/red] Access token is not present in response, please check logs.\nJSON: {}\nHeaders: {}".format(
-                    response_data, headers
-                )
+                f"[red][ERROR][/red] Access token is not present in response, please check logs.\nJSON: {response_data}\nHeaders: {headers}"
             )
             raise KeyError("data")
 
-    return {streamer_name: len(response_data["data"]) == 1}
+    live_set = {stream["user_login"].lower() for stream in response_data["data"]}
+    return {name.lower(): name.lower() in live_set for name in streamer_names}
 
 
 async def prepare_socket():
     """Prepares socket with authentication and returns it"""
 
     done, pending = await asyncio.wait(
-        [bot.wait("RPL_ENDOFMOTD"), bot.wait("ERR_NOMOTD")],
-        loop=bot.loop,
+        [
+            asyncio.create_task(bot.wait("RPL_ENDOFMOTD")),
+            asyncio.create_task(bot.wait("ERR_NOMOTD")),
+        ],
         return_when=asyncio.FIRST_COMPLETED,
-    )  # type: ignore
+    )
 
     # Cancel whichever waiter's event didn't come in.
     for future in pending:
@@ -260,59 +293,89 @@ async def prepare_socket():
 
 
 async def get_alive_streamers(
-    streamers: List[str], _session: Optional[aiohttp.ClientSession] = None
-):
+    streamers: List[str], session: aiohttp.ClientSession
+) -> Set[str]:
     """Gets all alive streamers"""
 
-    access_token = await retrieve_access_token(
-        config["client_id"], config["client_secret"], _session=_session
-    )
-    config["access_token"] = access_token
+    chunks = [
+        streamers[i : i + STREAMS_BATCH_SIZE]
+        for i in range(0, len(streamers), STREAMS_BATCH_SIZE)
+    ]
 
-    data = await asyncio.gather(
-        *[
-            retrieve_streaming_status(
-                config["client_id"],
-                access_token=access_token,
-                streamer_name=streamer,
-                _session=_session,
-            )
-            for streamer in streamers
-        ]
-    )
+    async def fetch_statuses(access_token: str):
+        # Built once per loop and shared by every batch
+        headers = {"Client-ID": config["client_id"], "Authorization": f"Bearer {access_token}"}
+
+        return await asyncio.gather(
+            *[
+                retrieve_streaming_statuses(
+                    headers,
+                    streamer_names=chunk,
+                    session=session,
+                )
+                for chunk in chunks
+            ]
+        )
 
-    result = [
-        k for k, v in dict(ChainMap(*data)).items() if v is True
-    ]  # A list of all the streamers whose values are True, ie, a list of channels that are streaming
+    try:
+        data = await fetch_statuses(await get_access_token(session))
+    except PermissionError:
+        # Cached token was rejected, refetch it once and retry
+        data = await fetch_statuses(await get_access_token(session, force_refresh=True))
+
+    result = {
+        name for chunk_statuses in data for name, live in chunk_statuses.items() if live
+    }  # All the streamers that are streaming, ie, the channels that should be joined
 
     return result
 
 
-async def join_channels(channels: List[str], bot: bottom.Client):
+def batch_channels(channels: Iterable[str], size: int = JOIN_BATCH_SIZE):
+    """Splits channels into comma separated IRC channel lists of at most `size` channels each."""
+
+    channels = list(channels)
+    return [
+        ",".join(CHANNEL_IRC.get(channel) or f"#{channel}" for channel in channels[i : i + size])
+        for i in range(0, len(channels), size)
+    ]
+
+
+async def join_channels(channels: Iterable[str], bot: bottom.Client):
     """Joins channels"""
 
-    for channel in channels:
-        bot.send("JOIN", channel="#{}".format(channel))
-        console.log("[cyan][JOIN][/cyan] - Joined channel {}".format(channel))
+    channels = list(channels)
+    for i, channel_list in enumerate(batch_channels(channels)):
+        if i != 0:
+            await asyncio.sleep(JOIN_BATCH_INTERVAL)
+        bot.send_raw(f"JOIN {channel_list}")
+
+    if channels:
+        console.log(f"[cyan][JOIN][/cyan] - Joined channels {', '.join(channels)}")
 
     return True
 
 
-async def leave_channels(channels: List[str], bot: bottom.Client):
+async def leave_channels(channels: Iterable[str], bot: bottom.Client):
     """Leaves channels"""
 
-    for channel in channels:
-        bot.send("PART", channel="#{}".format(channel))
-        console.log("[cyan][LEAVE][/cyan] - Left channel {}".format(channel))
+    channels = list(channels)
+    for channel_list in batch_channels(channels):
+        bot.send_raw(f"PART {channel_list}")
+
+    if channels:
+        console.log(f"[cyan][LEAVE][/cyan] - Left channels {', '.join(channels)}")
 
     return True
 
+
+async def _verbose_log(event_name: str, **kwargs):
+    console.log(f"{event_name} - {kwargs}")
+
+
 if config.get("verbose", False):
     all_events = [
-        "PING",
         "JOIN",
         "PART",
-        "PRIVMSG",
         "NOTICE",
         "USERMODE",
         "CHANNELMODE",
@@ -331,70 +394,369 @@ if config.get("verbose", False):
         "RPL_LUSERCHANNELS",
         "ERR_NOMOTD",
     ]
+    if config.get("verbose_chat", False):
+        # Highest frequency events, only logged when explicitly asked for
+        all_events += ["PING", "PRIVMSG"]
+
+    for event in all_events:
+        bot.on(event)(functools.partial(_verbose_log, event))
+
+
+# --- EventSub --- #
+
+
+async def retrieve_user_ids(
+    headers: dict,
+    streamer_names: List[str],
+    session: aiohttp.ClientSession,
+):
+    """Retrieves the user ids of up to 100 streamers in one request, EventSub subscriptions are made against ids, not logins."""
+
+    async with session.get(
+        "https://api.twitch.tv/helix/users",
+        params=[("login", name) for name in streamer_names],
+        headers=headers,
+    ) as response:
+        response_data = await response.json(loads=orjson.loads)
 
-    def event_handler(event_name: str, bot: bottom.Client):
+        if type(response_data.get("data")) is not list:
+            console.log(
+                f"[red][ERROR][/red] Failed to fetch user ids, please check logs.\nJSON: {response_data}"
+            )
+            raise KeyError("data")
 
-        @bot.on(event_name)
-        async def log(**kwargs):
-            console.log("{} - {}".format(event_name, kwargs))
-        
-        return log
+    return {user["login"].lower(): user["id"] for user in response_data["data"]}
 
-    [event_handler(event, bot) for event in all_events]
+
+async def validate_user_token(user_token: str, session: aiohttp.ClientSession):
+    """Validates the IRC oauth token and returns the client id it was issued for.
+
+    EventSub's WebSocket transport only accepts user access tokens, and Helix requires the Client-ID header to match the one the token was generated with."""
+
+    async with session.get(
+        "https://id.twitch.tv/oauth2/validate",
+        headers={"Authorization": f"OAuth {user_token}"},
+    ) as response:
+        response_data = await response.json(loads=orjson.loads)
+
+    client_id = response_data.get("client_id")
+    if client_id is None:
+        console.log(
+            f"[red][ERROR][/red] `oauth_token` could not be validated, EventSub needs a valid user token.\nJSON: {response_data}"
+        )
+        raise KeyError("client_id")
+
+    return client_id
+
+
+async def subscribe_stream_events(session_id: str, session: aiohttp.ClientSession):
+    """Subscribes the EventSub WebSocket session to `stream.online` and `stream.offline` for every configured channel."""
+
+    app_headers = {
+        "Client-ID": config["client_id"],
+        "Authorization": f"Bearer {await get_access_token(session)}",
+    }
+    streamers = config["channels"]
+    user_ids = {}
+    for i in range(0, len(streamers), STREAMS_BATCH_SIZE):
+        user_ids.update(
+            await retrieve_user_ids(
+                app_headers,
+                streamer_names=streamers[i : i + STREAMS_BATCH_SIZE],
+                session=session,
+            )
+        )
+
+    user_token = config["oauth_token"]
+    user_token = user_token[len("oauth:") :] if user_token.startswith("oauth:") else user_token
+    headers = {
+        "Client-ID": await validate_user_token(user_token, session=session),
+        "Authorization": f"Bearer {user_token}",
+    }
+
+    # Subscriptions count towards a per connection cost cap, so they're made one at a time and stop as soon as twitch says it's used up, the rest stay on polling
+    cost = {"total": 0, "max": None, "exceeded": False}
+
+    async def subscribe(event_type: str, user_id: str) -> bool:
+        body = {
+            "type": event_type,
+            "version": "1",
+            "condition": {"broadcaster_user_id": user_id},
+            "transport": {"method": "websocket", "session_id": session_id},
+        }
+        async with session.post(
+            "https://api.twitch.tv/helix/eventsub/subscriptions", json=body, headers=headers
+        ) as response:
+            response_data = await response.json(loads=orjson.loads)
+
+            if response.status == 429:
+                cost["exceeded"] = True
+                return False
+
+            if not 200 <= response.status < 300:
+                console.log(
+                    f"[yellow][WARNING][/yellow] Failed to subscribe to {event_type} for user id {user_id}.\nJSON: {response_data}"
+                )
+                return False
+
+        cost["total"] = response_data.get("total_cost", cost["total"])
+        cost["max"] = response_data.get("max_total_cost", cost["max"])
+        return True
+
+    for login, user_id in user_ids.items():
+        if cost["max"] is not None and cost["total"] + 2 > cost["max"]:
+            cost["exceeded"] = True  # Not enough left for both events of the next channel
+
+        if cost["exceeded"]:
+            break
+
+        if await subscribe("stream.online", user_id) and await subscribe(
+            "stream.offline", user_id
+        ):
+            EVENTSUB_CHANNELS[login] = user_id
+
+    console.log(
+        f"[cyan][LOG][/cyan] - Subscribed to stream events for {list(EVENTSUB_CHANNELS)}"
+    )
+    not_subscribed = [name.lower() for name in streamers if name.lower() not in EVENTSUB_CHANNELS]
+    if not_subscribed:
+        reason = "the EventSub subscription cost limit was reached" if cost["exceeded"] else "subscribing failed"
+        console.log(
+            f"[yellow][WARNING][/yellow] Couldn't subscribe to stream events for {not_subscribed} ({reason}), they'll keep being polled every `wait_time` seconds."
+        )
+
+
+async def handle_stream_event(event_type: str, event: dict):
+    """Joins or leaves a channel as soon as EventSub reports it went online or offline."""
+
+    streamer = event["broadcaster_user_login"].lower()
+
+    async with STREAMER_LISTS_LOCK:
+        if event_type == "stream.online":
+            EVENTSUB_ONLINE_AT[streamer] = time.monotonic()
+            EVENTSUB_OFFLINE_AT.pop(streamer, None)
+            if streamer not in STREAMER_LISTS["joined"]:
+                await join_channels([streamer], bot=bot)
+                STREAMER_LISTS["joined"] = STREAMER_LISTS["joined"] | {streamer}
+                STREAMER_LISTS["offline"] = STREAMER_LISTS["offline"] - {streamer}
+
+        elif event_type == "stream.offline":
+            EVENTSUB_OFFLINE_AT[streamer] = time.monotonic()
+            EVENTSUB_ONLINE_AT.pop(streamer, None)
+            if streamer in STREAMER_LISTS["joined"]:
+                await leave_channels([streamer], bot=bot)
+                STREAMER_LISTS["joined"] = STREAMER_LISTS["joined"] - {streamer}
+                STREAMER_LISTS["offline"] = STREAMER_LISTS["offline"] | {streamer}
+
+
+async def eventsub_loop(session: aiohttp.ClientSession):
+    """Listens on EventSub's WebSocket for streams going online/offline, reconnecting whenever the connection drops."""
+
+    retry_delay = 2
+
+    while True:
+        ws = None
+        subscribed = False  # Subscriptions carry over when twitch asks us to move to a new url
+
+        try:
+            ws = await session.ws_connect(
+                EVENTSUB_URL, receive_timeout=EVENTSUB_RECEIVE_TIMEOUT
+            )
+
+            while True:
+                message = await ws.receive()
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break  # Closed or errored, start over with a fresh session
+
+                data = message.json(loads=orjson.loads)
+                message_type = data["metadata"]["message_type"]
+                payload = data["payload"]
+
+                if message_type == "session_welcome":
+                    if not subscribed:
+                        await subscribe_stream_events(
+                            payload["session"]["id"], session=session
+                        )
+                        subscribed = True
+                        retry_delay = 2
+
+                elif message_type == "notification":
+                    try:
+                        await handle_stream_event(
+                            payload["subscription"]["type"], payload["event"]
+                        )
+                    except Exception as e:
+                        # eg. IRC is reconnecting, or the payload isn't shaped like we expect. One bad notification shouldn't drop the connection
+                        console.log(
+                            f"[yellow][WARNING][/yellow] Failed to handle EventSub notification ({repr(e)}).\nJSON: {data}"
+                        )
+
+                elif message_type == "session_reconnect":
+                    # The old connection has to stay open until the new one is up, otherwise the subscriptions are dropped
+                    new_ws = await session.ws_connect(
+                        payload["session"]["reconnect_url"],
+                        receive_timeout=EVENTSUB_RECEIVE_TIMEOUT,
+                    )
+                    await ws.close()
+                    ws = new_ws
+
+                elif message_type == "revocation":
+                    console.log(
+                        f"[yellow][WARNING][/yellow] EventSub subscription revoked, {payload['subscription']}"
+                    )
+                    # Go back to polling the channel every wait_time
+                    user_id = payload["subscription"]["condition"]["broadcaster_user_id"]
+                    for login in [k for k, v in EVENTSUB_CHANNELS.items() if v == user_id]:
+                        del EVENTSUB_CHANNELS[login]
+
+                # session_keepalive needs no handling, receiving it is enough
+
+            console.log("[yellow][WARNING][/yellow] EventSub connection closed, reconnecting.")
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            console.log(
+                f"[yellow][WARNING][/yellow] EventSub connection lost ({repr(e)}), reconnecting."
+            )
+
+        except Exception as e:
+            if session.closed:
+                raise  # Shutting down, nothing to reconnect with
+
+            # eg. the user token expired or twitch sent something unexpected. Channels fall back to polling, the IRC connection is left alone
+            console.log(
+                f"[red][ERROR][/red] EventSub failed ({repr(e)}), reconnecting in {retry_delay} seconds."
+            )
+
+        finally:
+            EVENTSUB_CHANNELS.clear()  # Subscriptions die with the session, poll everything until we've resubscribed
+            if ws is not None and not ws.closed:
+                await ws.close()
+
+        await asyncio.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, EVENTSUB_MAX_RETRY_DELAY)
 
 
 # --- Main --- #
 
 
-async def main():
-    """Main Loop"""
+async def _poll_loop():
+    """Polls the streams endpoint and joins/leaves channels according to who's live."""
 
-    session = aiohttp.ClientSession()
     bot = await prepare_socket()
 
     console.log("[cyan][LOG][/cyan] - Socket Prepared")
 
+    wait_time = int(config["wait_time"])
+    last_full_poll = float("-inf")
+
     while True:
         console.rule("Beginning Loop")
 
+        # Channels covered by EventSub get pushed to us, so they're only polled every EVENTSUB_RECONCILE_INTERVAL as a safety net. Everything else is polled every loop
+        if (
+            not config.get("eventsub", False)
+            or time.monotonic() - last_full_poll >= EVENTSUB_RECONCILE_INTERVAL
+        ):
+            polled_streamers = list(config["channels"])
+            last_full_poll = time.monotonic()
+        else:
+            polled_streamers = [
+                name for name in config["channels"] if name.lower() not in EVENTSUB_CHANNELS
+            ]
+
+        if not polled_streamers:
+            await asyncio.sleep(wait_time)
+            continue
+
         # Alive Streamers are retrieved through the API, that's compared with the currently alive streamers to see the difference, ie, who's new and who's gone offline, then leave/join according channels, then update the config for the next loop
 
-        currently_alive_streamers = set(
-            await get_alive_streamers(config["channels"], _session=session)
-        )
-        console.log(config)
-        console.log(
-            "[cyan][LOG][/cyan] - Alive Streamers Retrieved, {}".format(
-                currently_alive_streamers
-            )
+        currently_alive_streamers = await get_alive_streamers(
+            polled_streamers, session=SESSION
         )
 
-        previous_alive_streamers: set = STREAMER_LISTS.get("joined", set())
-        now_offline_streamers = previous_alive_streamers.difference(
-            currently_alive_streamers
-        )
-        console.log(
-            "[cyan][LOG][/cyan] - Offline Streamers Retrieved, {}".format(
-                now_offline_streamers
-            )
-        )
-        to_join_streamers = currently_alive_streamers.difference(
-            STREAMER_LISTS.get("joined", set())
-        )
+        def within_grace(name: str, notified_at: dict):
+            return time.monotonic() - notified_at.get(name, float("-inf")) < EVENTSUB_GRACE
+
+        # Diffing, sending and updating all happen under the lock, so an EventSub notification can't slip in while join_channels waits between batches
+        async with STREAMER_LISTS_LOCK:
+            previous_alive_streamers = STREAMER_LISTS["joined"] & {
+                name.lower() for name in polled_streamers
+            }
+            # Channels EventSub just reported online/offline may not be listed/unlisted by Helix yet
+            now_offline_streamers = {
+                name
+                for name in previous_alive_streamers - currently_alive_streamers
+                if not within_grace(name, EVENTSUB_ONLINE_AT)
+            }
+            to_join_streamers = {
+                name
+                for name in currently_alive_streamers - STREAMER_LISTS["joined"]
+                if not within_grace(name, EVENTSUB_OFFLINE_AT)
+            }
+
+            changed = bool(now_offline_streamers or to_join_streamers)  # Nothing to log or send when nothing changed since the last loop
+            if changed:
+                console.log(config)
+                console.log(
+                    f"[cyan][LOG][/cyan] - Alive Streamers Retrieved, {currently_alive_streamers}"
+                )
+                console.log(
+                    f"[cyan][LOG][/cyan] - Now Offline Streamers Retrieved, {now_offline_streamers}"
+                )
+
+                await leave_channels(now_offline_streamers, bot=bot)
+                await join_channels(to_join_streamers, bot=bot)
 
-        STREAMER_LISTS["joined"] = currently_alive_streamers
-        STREAMER_LISTS["offline"] = now_offline_streamers
+                STREAMER_LISTS["joined"] = (
+                    STREAMER_LISTS["joined"] - now_offline_streamers
+                ) | to_join_streamers
+                STREAMER_LISTS["offline"] = set(CHANNEL_IRC) - STREAMER_LISTS["joined"]
 
-        await leave_channels(list(now_offline_streamers), bot=bot)
-        await join_channels(list(to_join_streamers), bot=bot)
+        if changed:
+            console.rule("Sleeping")
 
-        console.rule("Sleeping")
+        await asyncio.sleep(wait_time)
+
+
+async def main():
+    """Main Loop"""
+
+    global SESSION
+
+    # Registered on the running loop so the handler is scheduled as a regular callback, not run between bytecodes
+    bot.loop.add_signal_handler(signal.SIGINT, lambda: asyncio.create_task(handle()))
+
+    # One session for the lifetime of the program, so connections to id.twitch.tv and api.twitch.tv are kept alive between loops instead of doing a new TCP + TLS handshake every request.
+    SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=200,
+            limit_per_host=64,
+            ttl_dns_cache=600,
+            keepalive_timeout=60,
+            enable_cleanup_closed=True,
+        ),
+        timeout=aiohttp.ClientTimeout(total=30),
+    )
+
+    tasks = [asyncio.create_task(bot.connect()), asyncio.create_task(_poll_loop())]
+    if config.get("eventsub", False):
+        tasks.append(asyncio.create_task(eventsub_loop(SESSION)))
+
+    # gather propagates the first exception, so a crashing task stops the program (letting a supervisor restart it) instead of leaving it running with no channels joined
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # gather doesn't cancel the other tasks like a TaskGroup would, so do it here, before the session they use is closed
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
 
-        await asyncio.sleep(int(config["wait_time"]))
+        if not SESSION.closed:
+            await SESSION.close()
 
 
 # --- Running --- #
 
-bot.loop.create_task(bot.connect())
-bot.loop.create_task(main())
-bot.loop.run_forever()  # Ctrl + C here
+# bottom binds its client to the loop it was created with, so main has to run on that loop rather than a new one from asyncio.run
+bot.loop.run_until_complete(main())  # Ctrl + C here